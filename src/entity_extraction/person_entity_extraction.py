@@ -1,11 +1,72 @@
+import functools
+import os
 import re
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator
+from operator import itemgetter
 
+import numpy as np
 import requests
 import spacy
+from numba import njit, types
+from numba.typed import Dict
+from spacy.tokens import Doc
 
 from http_models.common_http_models import CommonResponse
 from http_models.entity_extraction_http_models import PersonInfoRequest, PersonInfoResponse, Person
 
+_MULTI_WS_RE = re.compile(r'[\.\s]{2,}')
+_CHUNK_SIZE = 100_000
+_TRAILING_WS_RE = re.compile(r'(?<![\.\s])[\.\s]*\Z')
+_DOWNLOAD_CHUNK_SIZE = 65536
+_REQUEST_TIMEOUT = 30
+_RESULT_CACHE_SIZE = 32
+
+
+class _FetchError(Exception):
+    """
+    Raised inside the cached extraction so that failed fetches are not memoized
+    """
+
+    def __init__(self, response: CommonResponse):
+        super().__init__(response.message)
+        self.response = response
+
+
+@njit(cache=True)
+def _count_locations_in_windows(win_starts, win_ends, person_ids, loc_starts, loc_ids, num_locs):
+    """
+    Count the locations starting inside each person's search window. Only the (person, location) pairs
+    that occur are stored, keyed by person_id * num_locs + loc_id
+    :param win_starts: start characters of the search windows
+    :param win_ends: end characters of the search windows
+    :param person_ids: person index of each search window
+    :param loc_starts: sorted start characters of the location mentions
+    :param loc_ids: location index of each location mention
+    :param num_locs: number of distinct locations
+    :return: array of pair keys, array of counts, array of the first window each pair was found in
+    """
+    pair_counts = Dict.empty(key_type=types.int64, value_type=types.int64)
+    pair_first_windows = Dict.empty(key_type=types.int64, value_type=types.int64)
+    lo = np.searchsorted(loc_starts, win_starts)
+    hi = np.searchsorted(loc_starts, win_ends)
+    for w in range(len(win_starts)):
+        for k in range(lo[w], hi[w]):
+            key = np.int64(person_ids[w]) * num_locs + loc_ids[k]
+            if key in pair_counts:
+                pair_counts[key] += 1
+            else:
+                pair_counts[key] = 1
+                pair_first_windows[key] = w
+    keys = np.empty(len(pair_counts), dtype=np.int64)
+    counts = np.empty(len(pair_counts), dtype=np.int64)
+    first_windows = np.empty(len(pair_counts), dtype=np.int64)
+    for i, key in enumerate(pair_counts.keys()):
+        keys[i] = key
+        counts[i] = pair_counts[key]
+        first_windows[i] = pair_first_windows[key]
+    return keys, counts, first_windows
+
 
 class PersonEntityExtractor:
     """
@@ -14,10 +75,30 @@ class PersonEntityExtractor:
     @author Pooja Savant
     """
 
-    def __init__(self):
-        self.nlp = spacy.load("en_core_web_sm")
-        self.nlp.disable_pipes(["tagger", "parser", "attribute_ruler", "lemmatizer"])
-        print("NLP Model setup:", self.nlp.analyze_pipes())
+    _nlp = None
+    _use_gpu = False
+
+    def __init__(self, n_process: int = 1):
+        """
+        :param n_process: number of processes to run NER with, 0 or less to use all the CPUs.
+                Keep it at 1 inside a server, where forking from a request thread is unsafe
+        """
+        self.nlp, self.use_gpu = self.load_nlp()
+        self.n_process = n_process if n_process > 0 else (os.cpu_count() or 1)
+        self.session = requests.Session()
+        self.extract_people = functools.lru_cache(maxsize=_RESULT_CACHE_SIZE)(self.extract_people_from_url)
+
+    @classmethod
+    def load_nlp(cls):
+        """
+        Load the spacy model on first use and share it between all the extractor instances
+        :return: spacy Language object, whether it runs on GPU
+        """
+        if cls._nlp is None:
+            cls._use_gpu = spacy.prefer_gpu()
+            cls._nlp = spacy.load("en_core_web_sm", exclude=["tagger", "parser", "attribute_ruler", "lemmatizer"])
+            print("NLP Model setup:", cls._nlp.analyze_pipes(), "GPU:", cls._use_gpu)
+        return cls._nlp, cls._use_gpu
 
     def get_all_people_details(self, person_info_request: PersonInfoRequest) -> PersonInfoResponse | CommonResponse:
         """
@@ -27,13 +108,48 @@ class PersonEntityExtractor:
         :param person_info_request: PersonInfoRequest
         :return: PersonInfoResponse | CommonResponse
         """
-        doc_text = self.fetch_text_from_url(person_info_request.url)
-        if not isinstance(doc_text, str):
-            return doc_text
-        people_loc_list = self.get_people_places_details(doc_text, lookup_location_by=100)
+        url = person_info_request.url
+        url_version = self.get_url_version(url)
+        # Without any validator a cached result could never be invalidated, so extract again
+        extract_people = self.extract_people if any(url_version) else self.extract_people_from_url
+        try:
+            people_loc_list = extract_people(url, url_version, 100)
+        except _FetchError as e:
+            return e.response
         response_dict = person_info_request.dict()
-        response_dict['people'] = [Person(**people_loc_dict) for people_loc_dict in people_loc_list]
-        return PersonInfoResponse.parse_obj(response_dict)
+        response_dict['people'] = [Person.construct(name=name, count=count,
+                                                    associated_places=[{'name': loc, 'count': loc_count}
+                                                                       for loc, loc_count in places])
+                                   for name, count, places in people_loc_list]
+        return PersonInfoResponse.construct(**response_dict)
+
+    def extract_people_from_url(self, url: str, url_version: tuple, lookup_location_by: int) -> tuple:
+        """
+        Fetch the text from the URL and extract the people details as nested tuples, so that the result
+        can be memoized by self.extract_people. The url_version only takes part in the cache key
+        :param url: str
+        :param url_version: tuple of ETag and Last-Modified headers of the URL
+        :param lookup_location_by: int
+        :return: tuple of (name, count, tuple of (place name, count)) per person
+        """
+        doc_text = self.fetch_text_from_url(url)
+        if not isinstance(doc_text, str):
+            raise _FetchError(doc_text)
+        people_loc_list = self.get_people_places_details(doc_text, lookup_location_by=lookup_location_by)
+        return tuple((people_loc_dict['name'], people_loc_dict['count'],
+                      tuple((place['name'], place['count']) for place in people_loc_dict['associated_places']))
+                     for people_loc_dict in people_loc_list)
+
+    def get_url_version(self, url: str) -> tuple:
+        """
+        Get the validators of the document behind the URL, used to invalidate cached results
+        :param url: str
+        :return: tuple of ETag and Last-Modified headers, None when not sent or HEAD is not supported
+        """
+        resp = self.session.head(url, allow_redirects=True, timeout=_REQUEST_TIMEOUT)
+        if not resp.ok:
+            return None, None
+        return resp.headers.get('ETag'), resp.headers.get('Last-Modified')
 
     def fetch_text_from_url(self, url: str) -> str | CommonResponse:
         """
@@ -41,24 +157,40 @@ class PersonEntityExtractor:
         :param url:
         :return:
         """
-        resp = requests.get(url)
-        if resp.status_code == 200:
-            text = resp.text
-            text = self.clean_text(text)
-            return text
-        else:
-            return CommonResponse(status_code=500, message="Error while fetching text from url")
+        with self.session.get(url, stream=True, timeout=_REQUEST_TIMEOUT) as resp:
+            if resp.status_code == 200:
+                resp.encoding = resp.encoding or 'utf-8'
+                chunks = resp.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE, decode_unicode=True)
+                return ''.join(self.clean_text_chunks(chunks))
+            else:
+                return CommonResponse(status_code=500, message="Error while fetching text from url")
 
     @staticmethod
     def clean_text(text: str) -> str:
         """
-        Basic steps to clean the text
+        Basic steps to clean the text. A CRLF line break is itself a run of two whitespace characters,
+        so a single pass collapsing runs of dots and whitespace also turns line breaks into '. '
         :param text:
         :return:
         """
-        cleaned_text = text.replace('\r\n', '. ')
-        cleaned_text = re.sub(r'[\.\s]{2,}', '. ', cleaned_text)
-        return cleaned_text
+        return _MULTI_WS_RE.sub('. ', text)
+
+    @staticmethod
+    def clean_text_chunks(chunks: Iterable[str]) -> Iterator[str]:
+        """
+        Clean the text chunk by chunk as it is downloaded. Any trailing run of dots and whitespace is
+        carried over to the next chunk, so the joined output is the same as cleaning the whole text.
+        A carried run longer than two characters is cut down to two, since it is collapsed the same way
+        :param chunks: iterable of text chunks
+        :return: iterator of cleaned text chunks
+        """
+        pending = ''
+        for chunk in chunks:
+            chunk = pending + chunk
+            split_at = _TRAILING_WS_RE.search(chunk).start()
+            pending = chunk[split_at:split_at + 2]
+            yield PersonEntityExtractor.clean_text(chunk[:split_at])
+        yield PersonEntityExtractor.clean_text(pending)
 
     def get_people_places_details(self, doc_text: str, lookup_location_by: int = 100) -> list[dict]:
         """
@@ -68,42 +200,45 @@ class PersonEntityExtractor:
         :param lookup_location_by: int
         :return: list of people with their frequency and location details
         """
-        spacy_doc = self.nlp(doc_text)
-        token_spans = self.get_all_tokens(spacy_doc)
+        chunks = self.split_text(doc_text, _CHUNK_SIZE) if self.n_process > 1 and not self.use_gpu else [doc_text]
+        if len(chunks) == 1:
+            spacy_doc = self.nlp(doc_text)
+        else:
+            # spacy hands out whole batches to the worker processes, so send one chunk per batch
+            docs = self.nlp.pipe(chunks, batch_size=1, n_process=min(self.n_process, len(chunks)))
+            spacy_doc = Doc.from_docs(list(docs), ensure_whitespace=False)
         location_dict, people_dict = self.extract_person_location_entities(spacy_doc)
-        people_dict = self.accumulate_locations_near_person(people_dict, location_dict,
-                                                            token_spans, lookup_location_by)
+        people_dict = self.accumulate_locations_near_person(people_dict, location_dict, spacy_doc,
+                                                            lookup_location_by)
 
         people_details_list = []
         for person, value in people_dict.items():
             person_details_dict = {'name': person, 'count': len(value['spans'])}
-            place_detail_list = []
-            if 'location' in value:
-                for loc, loc_count in value['location'].items():
-                    place_detail_list.append({
-                        'name': loc,
-                        'count': loc_count
-                    })
-                place_detail_list = sorted(place_detail_list, key=lambda d: d['count'], reverse=True)
-            person_details_dict['associated_places'] = place_detail_list
+            location_counter = value.get('location', Counter())
+            person_details_dict['associated_places'] = [{'name': loc, 'count': loc_count}
+                                                        for loc, loc_count in location_counter.most_common()]
             people_details_list.append(person_details_dict)
-        people_details_list = sorted(people_details_list, key=lambda d: d['count'], reverse=True)
+        people_details_list = sorted(people_details_list, key=itemgetter('count'), reverse=True)
         return people_details_list
 
     @staticmethod
-    def get_all_tokens(spacy_doc) -> list:
+    def split_text(text: str, chunk_size: int) -> list[str]:
         """
-        Method to get list of tokens from the spacy doc object along with the token span
-        :param spacy_doc:
-        :return: list of tokens with corresponding character span
+        Method to split the text into chunks of roughly chunk_size characters, breaking after a sentence
+        end where possible so that no entity is cut in half. Concatenating the chunks gives back the text
+        :param text: str
+        :param chunk_size: int
+        :return: list of text chunks
         """
-        token_spans = []
-        prev_span = -1
-        for token in spacy_doc:
-            end_span = prev_span + len(token.text_with_ws)
-            token_spans.append(((prev_span + 1, end_span), token.text))
-            prev_span = end_span
-        return token_spans
+        chunks = []
+        start = 0
+        while len(text) - start > chunk_size:
+            end = text.rfind('. ', start, start + chunk_size)
+            end = start + chunk_size if end < 0 else end + 2
+            chunks.append(text[start:end])
+            start = end
+        chunks.append(text[start:])
+        return chunks
 
     @staticmethod
     def extract_person_location_entities(spacy_doc):
@@ -113,57 +248,53 @@ class PersonEntityExtractor:
         :return: dict containing people name and their span tags,
                 dict containing locations and their span tags
         """
-        people_dict, location_dict = {}, {}
-        for entity in spacy_doc.ents:
-            if entity.label_ == 'PERSON':
-                if entity.text not in people_dict:
-                    people_dict[entity.text] = {'spans': [(entity.start_char, entity.end_char)]}
-                else:
-                    people_dict[entity.text]['spans'].append((entity.start_char, entity.end_char))
-            elif entity.label_ == 'GPE':
-                if entity.text not in location_dict:
-                    location_dict[entity.text] = [(entity.start_char, entity.end_char)]
-                else:
-                    location_dict[entity.text].append((entity.start_char, entity.end_char))
+        person_label, location_label = spacy_doc.vocab.strings['PERSON'], spacy_doc.vocab.strings['GPE']
+        entities = spacy_doc.ents
+        person_spans = [entity for entity in entities if entity.label == person_label]
+        location_spans = [entity for entity in entities if entity.label == location_label]
+        people_dict, location_dict = defaultdict(lambda: {'spans': []}), defaultdict(list)
+        for entity in person_spans:
+            people_dict[entity.text]['spans'].append((entity.start_char, entity.end_char))
+        for entity in location_spans:
+            location_dict[entity.text].append((entity.start_char, entity.end_char))
         return location_dict, people_dict
 
     @staticmethod
-    def accumulate_locations_near_person(people_dict: dict, location_dict: dict, token_spans: list,
+    def accumulate_locations_near_person(people_dict: dict, location_dict: dict, spacy_doc: Doc,
                                          lookup_location_by: int) -> dict:
         """
         Method to gather location mentioned around a person in the text along with it's frequency
         :param people_dict:
         :param location_dict:
-        :param token_spans:
+        :param spacy_doc:
         :param lookup_location_by:
         :return: dict containing people with location details
         """
-        for person, spans in people_dict.items():
-            for person_span in spans['spans']:
-                search_start_span = -1
-                search_end_span = -1
-                if person_span[0] == 0:
-                    search_start_span = 0
-                for i, token in enumerate(token_spans):
-                    if search_start_span < 0 and token[0][0] == person_span[0]:
-                        if i - lookup_location_by < 0:
-                            search_start_span = 0
-                        else:
-                            search_start_span = token_spans[i - lookup_location_by][0][0]
-                    if search_end_span < 0 and token[0][1] == person_span[1]:
-                        if i + lookup_location_by >= len(token_spans):
-                            search_end_span = token_spans[-1][0][1]
-                        else:
-                            search_end_span = token_spans[i + lookup_location_by][0][1]
-                    if search_start_span >= 0 and search_end_span > 0:
-                        break
-                for loc, loc_span_list in location_dict.items():
-                    for loc_span in loc_span_list:
-                        if search_start_span <= loc_span[0] < search_end_span:
-                            if 'location' not in people_dict[person]:
-                                people_dict[person]['location'] = {}
-                            if loc not in people_dict[person]['location']:
-                                people_dict[person]['location'][loc] = 1
-                            else:
-                                people_dict[person]['location'][loc] = people_dict[person]['location'][loc] + 1
+        person_names, loc_names = list(people_dict), list(location_dict)
+        person_spans = np.array([person_span for spans in people_dict.values() for person_span in spans['spans']],
+                                dtype=np.int32).reshape(-1, 2)
+        person_ids = np.repeat(np.arange(len(person_names), dtype=np.int32),
+                               [len(spans['spans']) for spans in people_dict.values()])
+
+        # Entity boundaries always fall on token boundaries, so searchsorted finds the exact tokens
+        token_starts = np.fromiter((token.idx for token in spacy_doc), dtype=np.int32, count=len(spacy_doc))
+        token_ends = token_starts + np.fromiter((len(token) for token in spacy_doc), dtype=np.int32,
+                                                count=len(spacy_doc))
+        first_tokens = np.searchsorted(token_starts, person_spans[:, 0])
+        last_tokens = np.searchsorted(token_ends, person_spans[:, 1])
+        win_starts = token_starts[np.maximum(0, first_tokens - lookup_location_by)]
+        win_ends = token_ends[np.minimum(len(spacy_doc) - 1, last_tokens + lookup_location_by)]
+
+        loc_events = sorted((loc_span[0], loc_id) for loc_id, loc_span_list in enumerate(location_dict.values())
+                            for loc_span in loc_span_list)
+
+        num_locs = max(1, len(loc_names))
+        keys, counts, first_windows = _count_locations_in_windows(
+            win_starts, win_ends, person_ids, np.array([start for start, _ in loc_events], dtype=np.int32),
+            np.array([loc_id for _, loc_id in loc_events], dtype=np.int32), num_locs)
+        pair_person_ids, pair_loc_ids = np.divmod(keys, num_locs)
+        # Insert in the order each place was first found for the person, so ties keep that order
+        for i in np.lexsort((pair_loc_ids, first_windows)):
+            location_counter = people_dict[person_names[pair_person_ids[i]]].setdefault('location', Counter())
+            location_counter[loc_names[pair_loc_ids[i]]] = int(counts[i])
         return people_dict
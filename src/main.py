@@ -17,7 +17,7 @@ app = FastAPI(
                 "<br>Author: Pooja Savant",
     version="0.0.1"
 )
-person_entity_extractor = PersonEntityExtractor()
+person_entity_extractor = PersonEntityExtractor(n_process=1)
 
 
 @app.get("/")
@@ -0,0 +1,220 @@
+import os
+import random
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+import spacy
+
+from entity_extraction import person_entity_extraction
+from entity_extraction.person_entity_extraction import PersonEntityExtractor, _count_locations_in_windows
+from http_models.common_http_models import CommonResponse
+from http_models.entity_extraction_http_models import PersonInfoRequest
+
+"""
+Unit test cases for the PersonEntityExtractor helpers that do not need the spacy model or network
+
+@author: Pooja Savant
+"""
+
+
+@pytest.fixture
+def nlp():
+    nlp = spacy.blank("en")
+    entity_ruler = nlp.add_pipe("entity_ruler")
+    entity_ruler.add_patterns([{"label": "PERSON", "pattern": "Harker"}, {"label": "PERSON", "pattern": "Mina"},
+                               {"label": "GPE", "pattern": "Whitby"}, {"label": "GPE", "pattern": "London"}])
+    return nlp
+
+
+@pytest.fixture
+def extractor(nlp, monkeypatch):
+    monkeypatch.setattr(PersonEntityExtractor, "_nlp", nlp)
+    monkeypatch.setattr(PersonEntityExtractor, "_use_gpu", False)
+    extractor = PersonEntityExtractor()
+    extractor.session = MagicMock()
+    return extractor
+
+
+def mock_url(session, text: str, status_code: int = 200, headers: dict | None = None):
+    session.head.return_value = MagicMock(ok=True, headers=headers or {})
+    resp = session.get.return_value.__enter__.return_value
+    resp.status_code = status_code
+    resp.encoding = 'utf-8'
+    resp.iter_content.side_effect = lambda **kwargs: iter([text])
+
+
+def split_into_random_chunks(text: str, rng: random.Random) -> list[str]:
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 6))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def test_clean_text_chunks_matches_clean_text():
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = ''.join(rng.choice('ab.. \r\n\t') for _ in range(rng.randint(0, 60)))
+        chunks = split_into_random_chunks(text, rng)
+        assert ''.join(PersonEntityExtractor.clean_text_chunks(chunks)) == PersonEntityExtractor.clean_text(text)
+
+
+def test_clean_text_chunks_long_run():
+    text = 'Dracula' + ' ' * 200_000 + '.\r\n' * 50_000 + 'Harker'
+    chunks = [text[i:i + 65536] for i in range(0, len(text), 65536)]
+    assert ''.join(PersonEntityExtractor.clean_text_chunks(chunks)) == 'Dracula. Harker'
+
+
+def test_split_text_concatenates_back():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = ''.join(rng.choice(['Harker', 'Mina', ' ', '. ', ',']) for _ in range(rng.randint(0, 200)))
+        chunks = PersonEntityExtractor.split_text(text, 50)
+        assert ''.join(chunks) == text
+        assert all(len(chunk) <= 50 for chunk in chunks)
+
+
+def test_split_text_breaks_after_sentence_end():
+    text = 'Jonathan Harker went to Transylvania. Mina stayed in Exeter. Van Helsing came from Amsterdam.'
+    chunks = PersonEntityExtractor.split_text(text, 40)
+    assert chunks == ['Jonathan Harker went to Transylvania. ', 'Mina stayed in Exeter. ',
+                      'Van Helsing came from Amsterdam.']
+
+
+def test_cached_until_etag_changes(extractor):
+    request = PersonInfoRequest(url="https://example.org/book.txt", title="Dracula")
+    mock_url(extractor.session, "Harker went to Whitby.", headers={'ETag': '"v1"'})
+    first = extractor.get_all_people_details(request)
+    assert extractor.get_all_people_details(request) == first
+    assert extractor.session.get.call_count == 1
+
+    mock_url(extractor.session, "Mina went to London.", headers={'ETag': '"v2"'})
+    response = extractor.get_all_people_details(request)
+    assert extractor.session.get.call_count == 2
+    assert [person.name for person in response.people] == ['Mina']
+    assert response.title == "Dracula"
+
+
+def test_failed_fetch_not_cached(extractor):
+    request = PersonInfoRequest(url="https://example.org/book.txt")
+    mock_url(extractor.session, "", status_code=503, headers={'ETag': '"v1"'})
+    assert isinstance(extractor.get_all_people_details(request), CommonResponse)
+
+    mock_url(extractor.session, "Harker went to Whitby.", headers={'ETag': '"v1"'})
+    response = extractor.get_all_people_details(request)
+    assert extractor.session.get.call_count == 2
+    assert [person.name for person in response.people] == ['Harker']
+
+
+def test_not_cached_without_validators(extractor):
+    request = PersonInfoRequest(url="https://example.org/book.txt")
+    mock_url(extractor.session, "Harker went to Whitby.")
+    extractor.get_all_people_details(request)
+    extractor.session.head.return_value = MagicMock(ok=False, headers={'ETag': '"v1"'})
+    extractor.get_all_people_details(request)
+    assert extractor.session.get.call_count == 2
+
+
+def test_locations_near_person_followed_by_punctuation(nlp):
+    spacy_doc = nlp("Whitby is far. Harker. Mina, London and Whitby.")
+    location_dict, people_dict = PersonEntityExtractor.extract_person_location_entities(spacy_doc)
+    people_dict = PersonEntityExtractor.accumulate_locations_near_person(people_dict, location_dict, spacy_doc,
+                                                                         lookup_location_by=4)
+    assert people_dict['Harker']['location'] == {'Whitby': 1, 'London': 1}
+    assert people_dict['Mina']['location'] == {'London': 1, 'Whitby': 1}
+
+
+def test_chunked_multiprocess_matches_single_process(extractor, monkeypatch):
+    monkeypatch.setattr(person_entity_extraction, "_CHUNK_SIZE", 200)
+    text = ''.join(random.Random(0).choice(['Harker went to Whitby. ', 'Mina stayed in London. ', 'It rained. '])
+                   for _ in range(100))
+    expected = extractor.get_people_places_details(text, lookup_location_by=5)
+    extractor.n_process = 2
+    assert extractor.get_people_places_details(text, lookup_location_by=5) == expected
+
+
+def test_n_process_without_cpu_count(extractor, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: None)
+    assert PersonEntityExtractor(n_process=0).n_process == 1
+    assert PersonEntityExtractor().n_process == 1
+
+
+def test_count_locations_in_windows():
+    rng = random.Random(0)
+    for _ in range(300):
+        num_people, num_locs = rng.randint(1, 4), rng.randint(1, 4)
+        windows = [(start, start + rng.randint(1, 20), rng.randrange(num_people))
+                   for start in (rng.randint(0, 50) for _ in range(rng.randint(0, 8)))]
+        locations = sorted((rng.randint(0, 70), rng.randrange(num_locs)) for _ in range(rng.randint(0, 10)))
+        expected_counts, expected_first_windows = {}, {}
+        for w, (win_start, win_end, person_id) in enumerate(windows):
+            for loc_start, loc_id in locations:
+                if win_start <= loc_start < win_end:
+                    key = person_id * num_locs + loc_id
+                    expected_counts[key] = expected_counts.get(key, 0) + 1
+                    expected_first_windows.setdefault(key, w)
+
+        keys, counts, first_windows = _count_locations_in_windows(
+            np.array([window[0] for window in windows], dtype=np.int32),
+            np.array([window[1] for window in windows], dtype=np.int32),
+            np.array([window[2] for window in windows], dtype=np.int32),
+            np.array([location[0] for location in locations], dtype=np.int32),
+            np.array([location[1] for location in locations], dtype=np.int32), num_locs)
+        assert dict(zip(keys.tolist(), counts.tolist())) == expected_counts
+        assert dict(zip(keys.tolist(), first_windows.tolist())) == expected_first_windows
+
+
+def test_tied_places_keep_first_found_order(extractor):
+    people = extractor.get_people_places_details(
+        "London is far. Harker went to Whitby. Mina stayed. Harker saw London.", lookup_location_by=3)
+    harker = next(person for person in people if person['name'] == 'Harker')
+    assert [place['name'] for place in harker['associated_places']] == ['Whitby', 'London']
+
+    people = extractor.get_people_places_details(
+        "Whitby is far. Mina. Harker saw London and Whitby.", lookup_location_by=4)
+    harker = next(person for person in people if person['name'] == 'Harker')
+    assert [place['name'] for place in harker['associated_places']] == ['Whitby', 'London']
+
+
+def baseline_people_places_details(spacy_doc, lookup_location_by: int) -> list[dict]:
+    """
+    Reference copy of the original token scan and location counting, used to check the output order
+    """
+    token_spans = []
+    prev_span = -1
+    for token in spacy_doc:
+        end_span = prev_span + len(token.text_with_ws)
+        token_spans.append((prev_span + 1, end_span))
+        prev_span = end_span
+    location_dict, people_dict = {}, {}
+    for entity in spacy_doc.ents:
+        entity_dict = people_dict if entity.label_ == 'PERSON' else location_dict
+        entity_dict.setdefault(entity.text, []).append((entity.start_char, entity.end_char))
+
+    people_details_list = []
+    for person, spans in people_dict.items():
+        places = {}
+        for person_span in spans:
+            search_start_span = 0 if person_span[0] == 0 else -1
+            search_end_span = -1
+            for i, token_span in enumerate(token_spans):
+                if search_start_span < 0 and token_span[0] == person_span[0]:
+                    search_start_span = token_spans[max(0, i - lookup_location_by)][0]
+                if search_end_span < 0 and token_span[1] == person_span[1]:
+                    search_end_span = token_spans[min(len(token_spans) - 1, i + lookup_location_by)][1]
+            for loc, loc_span_list in location_dict.items():
+                for loc_span in loc_span_list:
+                    if search_start_span <= loc_span[0] < search_end_span:
+                        places[loc] = places.get(loc, 0) + 1
+        place_detail_list = sorted(({'name': loc, 'count': count} for loc, count in places.items()),
+                                   key=lambda d: d['count'], reverse=True)
+        people_details_list.append({'name': person, 'count': len(spans), 'associated_places': place_detail_list})
+    return sorted(people_details_list, key=lambda d: d['count'], reverse=True)
+
+
+def test_matches_baseline_on_text_without_punctuation(extractor, nlp):
+    rng = random.Random(0)
+    words = ['Harker', 'Mina', 'Whitby', 'London', 'went', 'to', 'the', 'sea']
+    for _ in range(300):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 60))) + ' '
+        lookup_location_by = rng.randint(1, 8)
+        assert (extractor.get_people_places_details(text, lookup_location_by)
+                == baseline_people_places_details(nlp(text), lookup_location_by))